@@ -1,87 +1,234 @@
 # backend/app.py
 
-import json
+from contextlib import asynccontextmanager
+
+import orjson
 import redis.asyncio as redis
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket
 
 from config.settings import settings
+from .job_events import JobEventHub
 from .model import GenerateRequest, GenerateResponse, JobResult
-from .utils import gen_job_id, OllamaModeClassifier
+from .utils import gen_job_id, OllamaModeClassifier, create_ollama_http_client
 from typing import Optional
 
 QUEUE_KEY = "image_jobs"
 JOB_KEY_PREFIX = "job:"
 LAST_IMAGE_PREFIX = "last_image:"
+JOB_EVENTS_PREFIX = "job_events:"
+IDEMPOTENCY_PREFIX = "idem:"  # idem:{user_id}:{request_id} -> job_id
+TERMINAL_STATUSES = ("done", "error")
+
+# Xóa idem key chỉ khi nó vẫn trỏ tới job này (key có thể đã hết hạn
+# và được request mới giữ cho job khác)
+DELETE_IF_OWNER_LUA = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 1 Redis client (kèm connection pool) dùng chung cho mọi request
+    app.state.redis = redis.from_url(
+        settings.REDIS_URL,
+        decode_responses=True,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+    )
+    # 1 HTTP client (keep-alive) tới Ollama + 1 instance classifier dùng chung
+    app.state.ollama_http = create_ollama_http_client(settings.OLLAMA_HOST)
+    app.state.classifier = OllamaModeClassifier(
+        host=settings.OLLAMA_HOST,
+        model=settings.OLLAMA_MODEL,
+        client=app.state.ollama_http,
+        num_predict=settings.OLLAMA_NUM_PREDICT,
+        think=settings.OLLAMA_THINK,
+    )
+    # 1 listener pub/sub chung, báo job xong cho các request long-poll/websocket
+    app.state.job_events = JobEventHub(app.state.redis, channel_prefix=JOB_EVENTS_PREFIX)
+    await app.state.job_events.start()
+    try:
+        yield
+    finally:
+        await app.state.job_events.stop()
+        await app.state.ollama_http.aclose()
+        await app.state.redis.aclose()
 
-app = FastAPI(title="Qwen Image Service")
-
-# Tạo 1 instance classifier dùng chung
-classifier = OllamaModeClassifier(
-    host=settings.OLLAMA_HOST,  
-    model=settings.OLLAMA_MODEL,                  
-)
-
-async def get_redis_client() -> redis.Redis:
-    return redis.from_url(settings.REDIS_URL, decode_responses=True)
 
+app = FastAPI(title="Qwen Image Service", lifespan=lifespan)
 
 @app.post("/generate", response_model=GenerateResponse)
-async def generate(req: GenerateRequest):
+async def generate(req: GenerateRequest, request: Request):
     if not req.prompt.strip():
         raise HTTPException(status_code=400, detail="Prompt không được để trống")
 
-    rds = await get_redis_client()
+    rds: redis.Redis = request.app.state.redis
+
+    job_id = gen_job_id()
+    job_key = f"{JOB_KEY_PREFIX}{job_id}"
+
+    # Ghi trạng thái waiting ngay (cùng transaction với việc giữ request_id),
+    # trước khi phân loại mode: request trùng nhận job_id nào thì job đó
+    # luôn đã có bản ghi để /result, /jobs/.../wait đọc được
+    idem_key: Optional[str] = None
+    async with rds.pipeline(transaction=True) as pipe:
+        pipe.set(
+            job_key,
+            orjson.dumps({
+                "status": "waiting",
+                "image_url": None,
+                "error_message": None,
+            }),
+        )
+        if req.request_id:
+            idem_key = f"{IDEMPOTENCY_PREFIX}{req.user_id}:{req.request_id}"
+            pipe.set(idem_key, job_id, nx=True, ex=settings.IDEMPOTENCY_TTL)
+        results = await pipe.execute()
+
+    if idem_key and not results[1]:
+        # Cùng request_id gửi lại khi job trước chưa xong (double submit, rerun)
+        # -> bỏ job vừa tạo, trả về job cũ, không phân loại / enqueue lần nữa
+        existing_id = await rds.get(idem_key)
+        if existing_id:
+            await rds.delete(job_key)
+            data = await rds.get(f"{JOB_KEY_PREFIX}{existing_id}")
+            status = orjson.loads(data).get("status", "waiting") if data else "waiting"
+            return GenerateResponse(job_id=existing_id, status=status)
+        # Key vừa hết hạn -> coi như request mới, không giữ key của người khác
+        idem_key = None
+
+    try:
+        return await _enqueue_job(rds, request, req, job_id, idem_key)
+    except Exception:
+        async with rds.pipeline(transaction=False) as pipe:
+            pipe.delete(job_key)
+            if idem_key:
+                pipe.eval(DELETE_IF_OWNER_LUA, 1, idem_key, job_id)
+            await pipe.execute()
+        raise
+
+
+async def _enqueue_job(
+    rds: redis.Redis,
+    request: Request,
+    req: GenerateRequest,
+    job_id: str,
+    idem_key: Optional[str],
+) -> GenerateResponse:
+    # Ảnh gần nhất của user: đọc 1 lần, dùng cho cả auto-mode lẫn EDIT
+    # và gửi kèm job để worker không phải đọc lại Redis
+    last_img: Optional[str] = None
+    if req.mode != "NEW":
+        last_img = await rds.get(f"{LAST_IMAGE_PREFIX}{req.user_id}")
 
     if req.mode is not None:
         mode = req.mode
     else:
         # Check user đã có ảnh trước đó chưa
-        last_img = await rds.get(f"{LAST_IMAGE_PREFIX}{req.user_id}")
-
         if not last_img:
             mode = "NEW"
         else:
-            mode = await classifier.classify_mode(req.prompt)
+            # Regex trước, chỉ hỏi LLM khi prompt không rõ ràng
+            mode = OllamaModeClassifier._quick_classify(req.prompt)
+            if mode is None:
+                classifier: OllamaModeClassifier = request.app.state.classifier
+                mode = await classifier.classify_mode(req.prompt)
             if mode is None:
                 mode = OllamaModeClassifier._fallback_rule(req.prompt)
 
-    # 3) Tạo job_id
-    job_id = gen_job_id()
-
     job_data = {
         "job_id": job_id,
         "user_id": req.user_id,
         "prompt": req.prompt,
         "mode": mode,
+        "last_image": last_img,
+        "idem_key": idem_key,
     }
 
-    # 4) Lưu trạng thái job ban đầu 
-    await rds.set(
-        f"{JOB_KEY_PREFIX}{job_id}",
-        json.dumps({
-            "status": "waiting",
-            "image_url": None,
-            "error_message": None,
-        }),
-    )
-
-    # 5) Đẩy job vào queue cho worker xử lý
-    await rds.lpush(QUEUE_KEY, json.dumps(job_data))
+    # Trạng thái waiting đã ghi ở generate() -> chỉ còn đẩy job vào queue
+    await rds.lpush(QUEUE_KEY, orjson.dumps(job_data))
 
     return GenerateResponse(job_id=job_id, status="waiting")
 
 
 @app.get("/result/{job_id}", response_model=JobResult)
-async def get_result(job_id: str):
+async def get_result(job_id: str, request: Request):
     """
     Trả về trạng thái job + image_url (nếu xong).
     """
-    rds = await get_redis_client()
+    rds: redis.Redis = request.app.state.redis
     data = await rds.get(f"{JOB_KEY_PREFIX}{job_id}")
     if not data:
         raise HTTPException(status_code=404, detail="Job không tồn tại")
 
-    obj = json.loads(data)
+    return _to_job_result(job_id, orjson.loads(data))
+
+
+@app.get("/jobs/{job_id}/wait", response_model=JobResult)
+async def wait_result(
+    job_id: str,
+    request: Request,
+    timeout: float = Query(25.0, gt=0, le=settings.RESULT_WAIT_TIMEOUT),
+):
+    """
+    Long-poll: giữ request cho đến khi job xong (done/error) hoặc hết timeout
+    giây, rồi trả về trạng thái hiện tại (giống /result).
+    """
+    obj = await _wait_for_job(request.app.state, job_id, timeout)
+    if obj is None:
+        raise HTTPException(status_code=404, detail="Job không tồn tại")
+
+    return _to_job_result(job_id, obj)
+
+
+@app.websocket("/ws/result/{job_id}")
+async def ws_result(websocket: WebSocket, job_id: str):
+    """
+    Đợi job xong (done/error) rồi gửi 1 message JobResult và đóng kết nối.
+    Worker publish lên kênh job_events:{job_id} khi job kết thúc, nên client
+    không cần poll /result. Nếu quá RESULT_WAIT_TIMEOUT giây thì gửi trạng thái
+    hiện tại (client tự quyết định chờ tiếp hay không).
+    """
+    await websocket.accept()
+    obj = await _wait_for_job(websocket.app.state, job_id, settings.RESULT_WAIT_TIMEOUT)
+    if obj is None:
+        await websocket.close(code=4404, reason="Job không tồn tại")
+        return
+
+    await websocket.send_json(_to_job_result(job_id, obj).model_dump())
+    await websocket.close()
+
+
+async def _wait_for_job(state, job_id: str, timeout: float) -> Optional[dict]:
+    """
+    Đợi job kết thúc (tối đa timeout giây) qua JobEventHub.
+    Trả về trạng thái job (có thể chưa xong nếu hết timeout), None nếu job không tồn tại.
+    """
+    rds: redis.Redis = state.redis
+    hub: JobEventHub = state.job_events
+    # Đăng ký trước rồi mới đọc trạng thái để không lỡ event
+    slot = hub.register(job_id)
+    try:
+        data = await rds.get(f"{JOB_KEY_PREFIX}{job_id}")
+        if not data:
+            return None
+
+        obj = orjson.loads(data)
+        if obj.get("status") in TERMINAL_STATUSES:
+            return obj
+
+        event = await hub.wait(slot, timeout)
+        if event is not None:
+            return event
+        data = await rds.get(f"{JOB_KEY_PREFIX}{job_id}")
+        return orjson.loads(data) if data else obj
+    finally:
+        hub.unregister(job_id, slot)
+
+
+def _to_job_result(job_id: str, obj: dict) -> JobResult:
     status = obj.get("status", "waiting")
     image_url: Optional[str] = obj.get("image_url")
     error_message: Optional[str] = obj.get("error_message")
@@ -91,5 +238,6 @@ async def get_result(job_id: str):
         status=status,
         image_url=image_url,
         error_message=error_message,
+        completed_at=obj.get("completed_at"),
         extra=None,
     )
@@ -1,13 +1,45 @@
 import asyncio
+import os
+import random
 from typing import Dict, Any, Optional, Tuple
 from pathlib import Path
 import uuid
 
+import aiofiles
 import httpx
+import orjson
+import websockets
 
 from config.settings import settings
 
 
+# 1 client (connection pool, keep-alive) dùng chung cho mọi call tới ComfyUI.
+# Khởi tạo/đóng bằng init_comfy_client() / close_comfy_client() (xem worker.main).
+_client: Optional[httpx.AsyncClient] = None
+
+
+async def init_comfy_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=300,
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+        )
+    return _client
+
+
+async def close_comfy_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    if _client is None:
+        raise RuntimeError("ComfyUI client chưa được khởi tạo, hãy gọi init_comfy_client() trước")
+    return _client
+
 
 async def send_workflow_to_comfy(workflow_json: Dict[str, Any], client_id=None) -> str:
     """
@@ -19,50 +51,127 @@ async def send_workflow_to_comfy(workflow_json: Dict[str, Any], client_id=None)
         "client_id": client_id,
     }
 
-    async with httpx.AsyncClient(timeout=300) as client:
-        r = await client.post(f"{settings.COMFYUI_URL}/prompt", json=payload)
-        
-        # Debug: Log response nếu bị lỗi
-        if r.status_code != 200:
-            print(f"[ComfyClient] ERROR: ComfyUI returned {r.status_code}")
-            print(f"[ComfyClient] Response: {r.text[:500]}")
-            try:
-                error_data = r.json()
-                if "error" in error_data:
-                    print(f"[ComfyClient] Error detail: {error_data['error']}")
-                if "node_errors" in error_data:
-                    print(f"[ComfyClient] Node errors: {error_data['node_errors']}")
-            except:
-                pass
-        
-        r.raise_for_status()
-        data = r.json()
-        # ComfyUI trả về {"prompt_id": "...", "number": ..., "node_errors": {}}
-        prompt_id = data.get("prompt_id")
-        if not prompt_id:
-            raise RuntimeError(f"ComfyUI không trả về prompt_id: {data}")
-        print(f"[ComfyClient] Got prompt_id: {prompt_id}")
-        return prompt_id
-
-
-async def wait_for_result(prompt_id: str, poll_interval: float = 1.0) -> Dict[str, Any]:
+    r = await _get_client().post(
+        f"{settings.COMFYUI_URL}/prompt",
+        content=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"},
+        timeout=300,
+    )
+
+    # Debug: Log response nếu bị lỗi
+    if r.status_code != 200:
+        print(f"[ComfyClient] ERROR: ComfyUI returned {r.status_code}")
+        print(f"[ComfyClient] Response: {r.text[:500]}")
+        try:
+            error_data = orjson.loads(r.content)
+            if "error" in error_data:
+                print(f"[ComfyClient] Error detail: {error_data['error']}")
+            if "node_errors" in error_data:
+                print(f"[ComfyClient] Node errors: {error_data['node_errors']}")
+        except:
+            pass
+
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    # ComfyUI trả về {"prompt_id": "...", "number": ..., "node_errors": {}}
+    prompt_id = data.get("prompt_id")
+    if not prompt_id:
+        raise RuntimeError(f"ComfyUI không trả về prompt_id: {data}")
+    print(f"[ComfyClient] Got prompt_id: {prompt_id}")
+    return prompt_id
+
+
+async def wait_for_result(
+    prompt_id: str,
+    poll_interval: float = 0.25,
+    max_poll_interval: float = 4.0,
+) -> Dict[str, Any]:
     """
     Poll /history/{prompt_id} cho đến khi có kết quả.
+    Khoảng chờ bắt đầu từ poll_interval và tăng gấp đôi sau mỗi lần chưa có
+    kết quả (tối đa max_poll_interval), cộng thêm một chút jitter ngẫu nhiên.
     Trả về history_item: history[prompt_id]
     """
     url = f"{settings.COMFYUI_URL}/history/{prompt_id}"
 
-    async with httpx.AsyncClient(timeout=300) as client:
-        while True:
-            r = await client.get(url)
-            print(f"[ComfyClient] Polling {url}, status={r.status_code}")
-            if r.status_code == 200:
-                data = r.json()
-                print(f"[ComfyClient] History keys: {list(data.keys())}")
-                if prompt_id in data:
-                    print(f"[ComfyClient] Found result for {prompt_id}")
-                    return data[prompt_id]
-            await asyncio.sleep(poll_interval)
+    client = _get_client()
+    delay = poll_interval
+    while True:
+        r = await client.get(url, timeout=300)
+        print(f"[ComfyClient] Polling {url}, status={r.status_code}")
+        if r.status_code == 200:
+            data = orjson.loads(r.content)
+            print(f"[ComfyClient] History keys: {list(data.keys())}")
+            if prompt_id in data:
+                print(f"[ComfyClient] Found result for {prompt_id}")
+                return data[prompt_id]
+        await asyncio.sleep(delay + random.uniform(0, delay * 0.1))
+        delay = min(delay * 2, max_poll_interval)
+
+
+def build_ws_url(client_id: str) -> str:
+    """
+    URL websocket của ComfyUI (/ws?clientId=...), http -> ws, https -> wss.
+    """
+    base = settings.COMFYUI_URL.rstrip("/")
+    if base.startswith("https://"):
+        base = "wss://" + base[len("https://"):]
+    elif base.startswith("http://"):
+        base = "ws://" + base[len("http://"):]
+    return f"{base}/ws?clientId={client_id}"
+
+
+async def wait_for_execution(ws, prompt_id: str) -> bool:
+    """
+    Đợi trên websocket cho đến khi ComfyUI chạy xong prompt_id.
+    ComfyUI gửi {"type": "executing", "data": {"node": null, "prompt_id": ...}}
+    sau khi đã ghi history, nên sau message này chỉ cần 1 lần GET /history.
+    Trả về False nếu websocket bị đóng trước khi job xong.
+    """
+    async for msg in ws:
+        # Bỏ qua frame binary (ảnh preview)
+        if not isinstance(msg, str):
+            continue
+        data = orjson.loads(msg)
+        msg_type = data.get("type")
+        msg_data = data.get("data") or {}
+        if msg_data.get("prompt_id") != prompt_id:
+            continue
+        if msg_type == "executing" and msg_data.get("node") is None:
+            return True
+        if msg_type in ("execution_error", "execution_interrupted"):
+            raise RuntimeError(
+                f"ComfyUI {msg_type}: {msg_data.get('exception_message', '')}".strip()
+            )
+    return False
+
+
+async def run_workflow(workflow_json: Dict[str, Any], client_id: str) -> Dict[str, Any]:
+    """
+    Gửi workflow và đợi kết quả qua websocket của ComfyUI (không polling).
+    Nếu không kết nối được websocket hoặc bị ngắt giữa chừng thì quay về
+    poll /history (wait_for_result).
+    Trả về history_item: history[prompt_id]
+    """
+    try:
+        ws = await websockets.connect(build_ws_url(client_id), max_size=None)
+    except Exception as e:
+        print(f"[ComfyClient] WARNING: Cannot open websocket ({e}), fallback to polling")
+        prompt_id = await send_workflow_to_comfy(workflow_json, client_id=client_id)
+        return await wait_for_result(prompt_id)
+
+    async with ws:
+        # Kết nối ws trước khi gửi prompt để không lỡ message nào
+        prompt_id = await send_workflow_to_comfy(workflow_json, client_id=client_id)
+        try:
+            finished = await wait_for_execution(ws, prompt_id)
+        except websockets.ConnectionClosedError:
+            finished = False
+        if not finished:
+            print("[ComfyClient] WARNING: Websocket closed, fallback to polling")
+
+    # History đã có sẵn -> thường chỉ cần 1 request
+    return await wait_for_result(prompt_id)
 
 
 def extract_first_image_from_history(history_item: Dict[str, Any]) -> Optional[Tuple[str, str, str]]:
@@ -108,23 +217,27 @@ async def copy_image_for_edit(image_url: str, comfyui_input_dir: str = None) ->
         print(f"[ComfyClient] Creating directory...")
         input_path.mkdir(parents=True, exist_ok=True)
     
-    # Download ảnh từ URL
-    print(f"[ComfyClient] Downloading image from: {image_url}")
-    async with httpx.AsyncClient(timeout=60) as client:
-        r = await client.get(image_url)
-        r.raise_for_status()
-        image_data = r.content
-    
     # Tạo filename unique để tránh conflict
     import urllib.parse as up
     parsed = up.urlparse(image_url)
     qs = up.parse_qs(parsed.query)
     original_filename = qs.get("filename", [f"edit_{uuid.uuid4().hex[:8]}.png"])[0]
     filename = Path(original_filename).name
-    
-    # Save vào input folder
     save_path = input_path / filename
-    save_path.write_bytes(image_data)
+
+    # Download ảnh từ URL, stream từng chunk thẳng xuống file tạm rồi rename
+    # (không giữ cả ảnh trong RAM, LoadImage không bao giờ đọc phải file ghi dở)
+    print(f"[ComfyClient] Downloading image from: {image_url}")
+    tmp_path = save_path.with_name(f".{filename}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        async with _get_client().stream("GET", image_url, timeout=60) as r:
+            r.raise_for_status()
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in r.aiter_bytes(65536):
+                    await f.write(chunk)
+        os.replace(tmp_path, save_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
     print(f"[ComfyClient] Saved image to ComfyUI input: {save_path}")
     
     return filename
@@ -0,0 +1,98 @@
+# backend/job_events.py
+
+import asyncio
+from typing import Any, Dict, Optional
+
+import orjson
+import redis.asyncio as redis
+
+
+class _JobSlot:
+    """
+    Trạng thái chờ của 1 job: event được set khi worker báo job kết thúc.
+    Nhiều request cùng đợi 1 job thì dùng chung 1 slot (đếm bằng refs).
+    """
+
+    __slots__ = ("done", "result", "refs")
+
+    def __init__(self) -> None:
+        self.done = asyncio.Event()
+        self.result: Optional[Dict[str, Any]] = None
+        self.refs = 0
+
+
+class JobEventHub:
+    """
+    1 kết nối pub/sub duy nhất (PSUBSCRIBE job_events:*) cho cả process API.
+    Mỗi request đang đợi job chỉ cần await 1 asyncio.Event, không phải mở
+    kết nối Redis riêng hay poll.
+    """
+
+    def __init__(self, rds: redis.Redis, channel_prefix: str = "job_events:"):
+        self._rds = rds
+        self._prefix = channel_prefix
+        self._slots: Dict[str, _JobSlot] = {}
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def register(self, job_id: str) -> _JobSlot:
+        """
+        Đăng ký đợi job_id. Gọi TRƯỚC khi đọc trạng thái job để không lỡ event,
+        và luôn gọi unregister() sau khi xong.
+        """
+        slot = self._slots.get(job_id)
+        if slot is None:
+            slot = self._slots[job_id] = _JobSlot()
+        slot.refs += 1
+        return slot
+
+    def unregister(self, job_id: str, slot: _JobSlot) -> None:
+        slot.refs -= 1
+        if slot.refs <= 0 and self._slots.get(job_id) is slot:
+            del self._slots[job_id]
+
+    async def wait(self, slot: _JobSlot, timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        Đợi job kết thúc, trả về trạng thái cuối, None nếu hết timeout.
+        """
+        try:
+            await asyncio.wait_for(slot.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return slot.result
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self._rds.pubsub()
+            try:
+                await pubsub.psubscribe(f"{self._prefix}*")
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    channel = message["channel"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    slot = self._slots.get(channel[len(self._prefix):])
+                    if slot is not None and not slot.done.is_set():
+                        slot.result = orjson.loads(message["data"])
+                        slot.done.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Mất kết nối Redis: request đang đợi sẽ hết timeout và tự đọc lại trạng thái
+                print(f"[JobEventHub] Pub/sub error: {e}, reconnecting...")
+                await asyncio.sleep(1.0)
+            finally:
+                await pubsub.aclose()
@@ -10,6 +10,7 @@ class GenerateRequest(BaseModel):
     user_id: str
     prompt: str
     mode: Optional[Mode] = None  # nếu None -> backend tự đoán
+    request_id: Optional[str] = None  # idempotency key: gửi lại khi job chưa xong -> trả về job cũ
 
 
 class GenerateResponse(BaseModel):
@@ -22,4 +23,5 @@ class JobResult(BaseModel):
     status: Literal["waiting", "processing", "done", "error"]
     image_url: Optional[str] = None
     error_message: Optional[str] = None
+    completed_at: Optional[str] = None  # ISO, worker ghi khi job done/error
     extra: Optional[Dict[str, Any]] = None
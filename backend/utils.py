@@ -1,39 +1,42 @@
-import json
+import asyncio
+import datetime
 import re
 import time
 import uuid
-from typing import Literal, Optional
+from collections import OrderedDict
+from typing import Dict, Literal, Optional, Tuple, Union
 
-import aiohttp
+import httpx
+import orjson
 
 Mode = Literal["NEW", "EDIT"]
 
+# Từ khoá EDIT cho _fallback_rule, gộp thành 1 regex (1 lần quét prompt).
+# Chỉ chặn biên đầu từ để vẫn bắt "edited", "removing"... nhưng bỏ "credit".
+_EDIT_RE = re.compile(
+    r"\b(?:edit|remove|erase|delete|change|fix|replace|add\s|make\s+(?:her|him)"
+    r"|xóa|xoá|sửa|chỉnh)",
+    re.IGNORECASE,
+)
 
-class OllamaModeClassifier:
-    """
-    Dùng Ollama (ví dụ model: 'turbo') để phân loại prompt là NEW hay EDIT.
-    """
-
-    def __init__(
-        self,
-        host: str = "http://127.0.0.1:11434",
-        model: str = "turbo",
-        api_key: Optional[str] = None,
-        request_timeout: float = 10.0,
-        dedupe_case_insensitive: bool = True,
-    ):
-        self.host = host.rstrip("/")
-        self.model = model
-        self.api_key = api_key
-        self.request_timeout = request_timeout
-        self.dedupe_case_insensitive = dedupe_case_insensitive
+# Động từ EDIT nguyên từ cho _quick_classify (chặn cả 2 biên, khác _EDIT_RE):
+# "fixing", "editor", "fixed-gear" không bị coi là yêu cầu sửa ảnh
+_EDIT_STRONG_RE = re.compile(
+    r"\b(?:edit|remove|erase|delete|change|fix|replace|add|make\s+(?:her|him)"
+    r"|xóa|xoá|sửa|chỉnh)\b",
+    re.IGNORECASE,
+)
 
-    async def classify_mode(self, prompt: str) -> Mode:
-        # Nếu prompt rỗng thì coi như NEW
-        if not prompt or not prompt.strip():
-            return "NEW"
+# Dấu hiệu prompt mô tả ảnh mới (dùng cho _quick_classify)
+_NEW_RE = re.compile(
+    r"\b(?:(?:a|an)\s+(?:photo|picture|image|portrait|painting|illustration)\s+of"
+    r"|draw|generate|create|render|realistic|photorealistic|illustration|portrait"
+    r"|vẽ|tạo)",
+    re.IGNORECASE,
+)
 
-        sys_prompt = f"""
+# Phần cố định của prompt gửi cho LLM (chỉ nối thêm prompt của user mỗi lần gọi)
+_SYS_PREAMBLE = """
 You are an image-request classifier for an image generation system.
 
 Your job is to read the user's text prompt and decide whether the user is:
@@ -52,97 +55,194 @@ Rules:
 
 Output STRICTLY in this JSON format, with no extra text:
 
-{{
+{
   "mode": "NEW"
-}}
+}
 
 or
 
-{{
+{
   "mode": "EDIT"
-}}
+}
+""".strip()
+
+# Lấy thẳng giá trị "mode" trong output của LLM (không cần tìm cả khối JSON)
+_MODE_RE = re.compile(r'"mode"\s*:\s*"(NEW|EDIT)"', re.IGNORECASE)
+
+
+class OllamaModeClassifier:
+    """
+    Dùng Ollama (ví dụ model: 'turbo') để phân loại prompt là NEW hay EDIT.
+    """
+
+    def __init__(
+        self,
+        host: str = "http://127.0.0.1:11434",
+        model: str = "turbo",
+        api_key: Optional[str] = None,
+        request_timeout: float = 10.0,
+        dedupe_case_insensitive: bool = True,
+        client: Optional[httpx.AsyncClient] = None,
+        cache_size: int = 1024,
+        cache_ttl: float = 300.0,
+        num_predict: int = 512,
+        think: Optional[Union[bool, str]] = None,
+    ):
+        self.host = host.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.request_timeout = request_timeout
+        self.dedupe_case_insensitive = dedupe_case_insensitive
+        self.num_predict = num_predict
+        # Mức suy luận cho model thinking (gpt-oss: "low"/"medium"/"high"), None: không gửi
+        self.think = think
+        # Client dùng chung (keep-alive) -> không phải bắt tay TCP/TLS lại mỗi lần classify
+        self._client = client or create_ollama_http_client(self.host, request_timeout)
+        # Cache LRU (có TTL) kết quả classify theo prompt đã chuẩn hoá
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache: "OrderedDict[str, Tuple[float, Mode]]" = OrderedDict()
+        # Request đang chạy theo prompt -> các call trùng prompt chờ chung 1 request
+        self._inflight: Dict[str, "asyncio.Task[Optional[Mode]]"] = {}
+
+    def _cache_key(self, prompt: str) -> str:
+        key = prompt.strip()
+        return key.lower() if self.dedupe_case_insensitive else key
+
+    def _cache_get(self, key: str) -> Optional[Mode]:
+        hit = self._cache.get(key)
+        if hit is None:
+            return None
+        expires_at, mode = hit
+        if expires_at < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return mode
+
+    def _cache_put(self, key: str, mode: Mode) -> None:
+        self._cache[key] = (time.monotonic() + self.cache_ttl, mode)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _forget_inflight(self, key: str, task: "asyncio.Task[Optional[Mode]]") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def classify_mode(self, prompt: str) -> Mode:
+        # Nếu prompt rỗng thì coi như NEW
+        if not prompt or not prompt.strip():
+            return "NEW"
+
+        key = self._cache_key(prompt)
+        mode = self._cache_get(key)
+        if mode is not None:
+            return mode
 
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._classify_remote(prompt))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget_inflight(k, t))
+        # shield: 1 caller bị cancel không được huỷ request của các caller khác
+        mode = await asyncio.shield(task)
+        if mode is None:
+            # LLM lỗi -> dùng rule, không cache để lần sau thử lại LLM
+            return self._fallback_rule(prompt)
+        self._cache_put(key, mode)
+        return mode
 
-"{prompt.strip()}"
-        """.strip()
+    async def _classify_remote(self, prompt: str) -> Optional[Mode]:
+        """
+        Gọi Ollama để phân loại. Trả về None nếu lỗi / không parse được.
+        """
+        sys_prompt = _SYS_PREAMBLE + '\n\n\n"' + prompt.strip() + '"'
 
         url = f"{self.host}/api/generate"
         headers = {"Content-Type": "application/json", "Accept": "application/json"}
         if self.api_key:
             headers["Authorization"] = f"Bearer {self.api_key}"
 
+        # format=json: model chỉ trả JSON; num_predict: giới hạn số token output
+        # (với model thinking gồm cả token suy luận, nên không đặt quá thấp)
         payload = {
             "model": self.model,
             "prompt": sys_prompt,
             "stream": False,
+            "format": "json",
+            "options": {"num_predict": self.num_predict, "temperature": 0},
         }
+        if self.think is not None:
+            payload["think"] = self.think
 
         text = ""
         try:
-            timeout = aiohttp.ClientTimeout(total=self.request_timeout)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(url, headers=headers, json=payload) as resp:
-                    if resp.status != 200:
-                        # Có thể log body nếu muốn debug
-                        body_text = await resp.text()
-                        print(
-                            f"[OllamaModeClassifier] HTTP {resp.status} from {url}: {body_text[:300]}"
-                        )
-                        resp.raise_for_status()
-                    body = await resp.json()
-                    # Ollama trả key "response" (tùy version, kiểm tra lại nếu khác)
-                    text = (body or {}).get("response", "") or ""
+            resp = await self._client.post(
+                url, headers=headers, json=payload, timeout=self.request_timeout
+            )
+            if resp.status_code != 200:
+                # Có thể log body nếu muốn debug
+                print(
+                    f"[OllamaModeClassifier] HTTP {resp.status_code} from {url}: {resp.text[:300]}"
+                )
+                resp.raise_for_status()
+            body = orjson.loads(resp.content)
+            # Ollama trả key "response" (tùy version, kiểm tra lại nếu khác)
+            text = (body or {}).get("response", "") or ""
         except Exception as e:
             print(f"[OllamaModeClassifier] Error calling Ollama: {e}")
-            return self._fallback_rule(prompt)
+            return None
 
-        # Parse JSON trong text trả về
+        # Với format=json, text chính là JSON {"mode": "..."}
         try:
-            # Tìm đoạn JSON trong text (giống code bạn gửi)
-            m = re.search(r"\{[\s\S]*\}", text)
-            if not m:
-                print("[OllamaModeClassifier] No JSON found in response, raw:", text[:200])
-                return self._fallback_rule(prompt)
-
-            parsed = json.loads(m.group())
-            mode_val = parsed.get("mode", "").strip().upper()
-            if mode_val not in ("NEW", "EDIT"):
-                return self._fallback_rule(prompt)
-            return mode_val  # type: ignore[return-value]
-        except Exception as e:
-            print(f"[OllamaModeClassifier] Error parsing JSON: {e}, raw={text[:200]}")
-            return self._fallback_rule(prompt)
+            parsed = orjson.loads(text)
+            mode_val = str(parsed.get("mode", "")).strip().upper()
+            if mode_val in ("NEW", "EDIT"):
+                return mode_val  # type: ignore[return-value]
+        except (orjson.JSONDecodeError, AttributeError):
+            pass
 
+        # Server không hỗ trợ format=json -> tìm giá trị mode trong text
+        m = _MODE_RE.search(text)
+        if not m:
+            print("[OllamaModeClassifier] No mode found in response, raw:", text[:200])
+            return None
+        return m.group(1).upper()  # type: ignore[return-value]
+
+    @staticmethod
+    def _quick_classify(prompt: str) -> Optional[Mode]:
+        """
+        Phân loại nhanh bằng regex, không gọi LLM:
+        - Chỉ có động từ EDIT (nguyên từ) -> "EDIT"
+        - Chỉ có dấu hiệu mô tả ảnh mới (a photo of, draw, generate...) -> "NEW"
+        - Có cả hai hoặc không có gì -> None (cần hỏi LLM)
+        """
+        p = prompt or ""
+        is_edit = _EDIT_STRONG_RE.search(p) is not None
+        is_new = _NEW_RE.search(p) is not None
+        if is_edit == is_new:
+            return None
+        return "EDIT" if is_edit else "NEW"
 
     @staticmethod
     def _fallback_rule(prompt: str) -> Mode:
         """
         Fallback đơn giản nếu LLM bị lỗi:
         """
-        p = (prompt or "").lower()
-        edit_keywords = [
-            "edit",
-            "remove",
-            "erase",
-            "delete",
-            "change",
-            "fix",
-            "replace",
-            "add ",
-            "add something",
-            "make her",
-            "make him",
-            "remove text",
-            "xóa",
-            "xoá",
-            "sửa",
-            "chỉnh",
-        ]
-        for kw in edit_keywords:
-            if kw in p:
-                return "EDIT"
-        return "NEW"
+        return "EDIT" if _EDIT_RE.search(prompt or "") else "NEW"
+
 
+def create_ollama_http_client(host: str, request_timeout: float = 10.0) -> httpx.AsyncClient:
+    """
+    Tạo httpx.AsyncClient dùng lâu dài cho Ollama (keep-alive + HTTP/2).
+    """
+    return httpx.AsyncClient(
+        base_url=host.rstrip("/"),
+        timeout=request_timeout,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60),
+    )
 
 
 def gen_job_id() -> str:
@@ -150,4 +250,9 @@ def gen_job_id() -> str:
 
 
 def get_timestamp_ms() -> int:
-    return int(time.time() * 1000)
\ No newline at end of file
+    return int(time.time() * 1000)
+
+
+def get_timestamp_iso() -> str:
+    """Thời điểm hiện tại dạng ISO (giờ local, tới giây), vd 2024-05-01T13:45:07"""
+    return datetime.datetime.now().isoformat(timespec="seconds")
\ No newline at end of file
@@ -1,30 +1,51 @@
 # backend/worker.py
 
 import asyncio
-import json
-from typing import Any, Dict
+from typing import Any, Dict, Set
 
+import orjson
 import redis.asyncio as redis
 
+try:
+    import uvloop
+except ImportError:  # uvloop không hỗ trợ Windows
+    uvloop = None
+
 from config.settings import settings
 
-from .workflow_builder import build_gen_workflow, build_edit_workflow
+from .utils import get_timestamp_iso
+from .workflow_builder import build_gen_workflow, build_edit_workflow, save_debug_workflow
 from .comfy_client import (
-    send_workflow_to_comfy,
-    wait_for_result,
+    run_workflow,
     extract_first_image_from_history,
     build_image_url,
     copy_image_for_edit,
+    init_comfy_client,
+    close_comfy_client,
 )
 
 
 QUEUE_KEY = "image_jobs"  # danh sách job
 JOB_KEY_PREFIX = "job:"   # job:{job_id}
 LAST_IMAGE_PREFIX = "last_image:"  # last_image:{user_id}
-
-
-async def get_redis_client() -> redis.Redis:
-    return redis.from_url(settings.REDIS_URL, decode_responses=True)
+JOB_EVENTS_PREFIX = "job_events:"  # kênh pub/sub job_events:{job_id}
+
+# Xóa idem key chỉ khi nó vẫn trỏ tới job này (key có thể đã hết hạn
+# và được request mới giữ cho job khác)
+DELETE_IF_OWNER_LUA = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def create_redis_client() -> redis.Redis:
+    return redis.from_url(
+        settings.REDIS_URL,
+        decode_responses=True,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+    )
 
 
 async def process_job(rds: redis.Redis, job_data: Dict[str, Any]) -> None:
@@ -32,20 +53,25 @@ async def process_job(rds: redis.Redis, job_data: Dict[str, Any]) -> None:
     user_id = job_data["user_id"]
     mode = job_data["mode"]          
     prompt = job_data["prompt"]
+    idem_key = job_data.get("idem_key")
 
     print(f"[Worker] Processing job {job_id}, mode={mode}, prompt={prompt[:50]}...")
 
     # Cập nhật trạng thái job -> processing
     await rds.set(
         f"{JOB_KEY_PREFIX}{job_id}",
-        json.dumps({"status": "processing", "image_url": None, "error_message": None}),
+        orjson.dumps({"status": "processing", "image_url": None, "error_message": None}),
     )
 
     try:
         if mode == "NEW":
             workflow = build_gen_workflow(prompt, job_id)
         else:
-            last_img = await rds.get(f"{LAST_IMAGE_PREFIX}{user_id}")
+            # API gửi sẵn last_image trong job; job cũ (chưa có key) thì đọc Redis
+            if "last_image" in job_data:
+                last_img = job_data["last_image"]
+            else:
+                last_img = await rds.get(f"{LAST_IMAGE_PREFIX}{user_id}")
             if not last_img:
                 # nếu chưa có ảnh, fallback sang GEN
                 workflow = build_gen_workflow(prompt, job_id)
@@ -69,16 +95,16 @@ async def process_job(rds: redis.Redis, job_data: Dict[str, Any]) -> None:
         print(f"[Worker] Sending workflow to ComfyUI, client_id={client_id}")
         print(f"[Worker] Workflow has {len(workflow)} nodes")
         
-        # Debug: Lưu workflow để kiểm tra
-        from .workflow_builder import save_debug_workflow
-        save_debug_workflow(workflow, f"debug_{mode}_{job_id[:8]}.json")
-        print(f"[Worker] Saved debug workflow to workflows/_debug/")
+        # Debug: Lưu workflow để kiểm tra (ghi file trong thread, không block event loop)
+        if settings.DEBUG_SAVE_WORKFLOWS:
+            await asyncio.to_thread(
+                save_debug_workflow, workflow, f"debug_{mode}_{job_id[:8]}.json"
+            )
+            print(f"[Worker] Saved debug workflow to workflows/_debug/")
         
-        prompt_id = await send_workflow_to_comfy(workflow, client_id=client_id)
-
-        # Đợi kết quả
-        print(f"[Worker] Waiting for ComfyUI result, prompt_id={prompt_id}...")
-        history_item = await wait_for_result(prompt_id)
+        # Gửi workflow + đợi kết quả qua websocket ComfyUI
+        print(f"[Worker] Waiting for ComfyUI result, client_id={client_id}...")
+        history_item = await run_workflow(workflow, client_id=client_id)
         print(f"[Worker] Got history item: {list(history_item.keys())}")
         img_info = extract_first_image_from_history(history_item)
         if not img_info:
@@ -89,19 +115,24 @@ async def process_job(rds: redis.Redis, job_data: Dict[str, Any]) -> None:
         print(f"[Worker] Image URL: {image_url}")
 
         # Lưu ảnh gần nhất cho user (phục vụ EDIT sau này)
-        await rds.set(f"{LAST_IMAGE_PREFIX}{user_id}", image_url)
-
-        # Cập nhật trạng thái job -> done
-        await rds.set(
-            f"{JOB_KEY_PREFIX}{job_id}",
-            json.dumps(
-                {
-                    "status": "done",
-                    "image_url": image_url,
-                    "error_message": None,
-                }
-            ),
+        # + cập nhật trạng thái job -> done + báo cho API (websocket /ws/result),
+        # gộp trong 1 round-trip
+        result = orjson.dumps(
+            {
+                "status": "done",
+                "image_url": image_url,
+                "error_message": None,
+                "completed_at": get_timestamp_iso(),
+            }
         )
+        async with rds.pipeline(transaction=False) as pipe:
+            pipe.set(f"{LAST_IMAGE_PREFIX}{user_id}", image_url)
+            pipe.set(f"{JOB_KEY_PREFIX}{job_id}", result)
+            pipe.publish(f"{JOB_EVENTS_PREFIX}{job_id}", result)
+            if idem_key:
+                # Job xong -> gửi lại cùng prompt sẽ tạo job mới
+                pipe.eval(DELETE_IF_OWNER_LUA, 1, idem_key, job_id)
+            await pipe.execute()
         print(f"[Worker] Job {job_id} completed successfully")
 
     except Exception as e:
@@ -109,41 +140,98 @@ async def process_job(rds: redis.Redis, job_data: Dict[str, Any]) -> None:
         print(f"[Worker] ERROR processing job {job_id}: {e}")
         import traceback
         traceback.print_exc()
-        await rds.set(
-            f"{JOB_KEY_PREFIX}{job_id}",
-            json.dumps(
-                {
-                    "status": "error",
-                    "image_url": None,
-                    "error_message": str(e),
-                }
-            ),
+        result = orjson.dumps(
+            {
+                "status": "error",
+                "image_url": None,
+                "error_message": str(e),
+                "completed_at": get_timestamp_iso(),
+            }
         )
+        async with rds.pipeline(transaction=False) as pipe:
+            pipe.set(f"{JOB_KEY_PREFIX}{job_id}", result)
+            pipe.publish(f"{JOB_EVENTS_PREFIX}{job_id}", result)
+            if idem_key:
+                pipe.eval(DELETE_IF_OWNER_LUA, 1, idem_key, job_id)
+            await pipe.execute()
+
+
+async def _run_job(rds: redis.Redis, worker_id: int, job_data: Dict[str, Any]) -> None:
+    try:
+        await process_job(rds, job_data)
+    except Exception as e:
+        print(f"[Worker {worker_id}] Unhandled error in job {job_data.get('job_id')}: {e}")
+
 
+async def worker_loop(rds: redis.Redis, worker_id: int, batch_size: int = 1) -> None:
+    """
+    Xử lý đồng thời tối đa batch_size job. Mỗi khi 1 job xong (trả slot)
+    thì lấy job tiếp theo ngay, không đợi cả nhóm xong.
+    """
+    print(f"[Worker {worker_id}] Started, batch_size={batch_size}")
 
-async def worker_loop(worker_id: int) -> None:
-    rds = await get_redis_client()
-    print(f"[Worker {worker_id}] Started")
+    slots = asyncio.Semaphore(batch_size)
+    running: Set["asyncio.Task[None]"] = set()
 
-    while True:
-        # BRPOP block đến khi có job mới
-        _, job_json = await rds.brpop(QUEUE_KEY)
+    def _on_done(task: "asyncio.Task[None]") -> None:
+        running.discard(task)
+        slots.release()
+
+    def _spawn(job_json: Any) -> None:
         try:
-            job_data = json.loads(job_json)
+            job_data = orjson.loads(job_json)
         except Exception:
             print(f"[Worker {worker_id}] Invalid job JSON: {job_json}")
-            continue
+            slots.release()
+            return
+        task = asyncio.create_task(_run_job(rds, worker_id, job_data))
+        running.add(task)
+        task.add_done_callback(_on_done)
 
-        print(f"[Worker {worker_id}] Processing job {job_data.get('job_id')}")
-        await process_job(rds, job_data)
-
-
-async def main(num_workers: int = 1) -> None:
-    tasks = [asyncio.create_task(worker_loop(i)) for i in range(num_workers)]
-    await asyncio.gather(*tasks)
+    try:
+        while True:
+            # Có slot trống mới BRPOP -> job mới vào queue được nhận ngay khi có slot
+            await slots.acquire()
+            _, job_json = await rds.brpop(QUEUE_KEY)
+            batch = [job_json]
+
+            # Còn slot trống thì lấy luôn (RPOP count) các job đang chờ khác,
+            # giữ thứ tự FIFO của queue
+            free = batch_size - len(running) - 1
+            if free > 0:
+                more = await rds.rpop(QUEUE_KEY, free)
+                for _ in more or []:
+                    await slots.acquire()  # không block: đã đếm đủ slot trống
+                batch.extend(more or [])
+
+            for job_json in batch:
+                _spawn(job_json)
+    finally:
+        for task in running:
+            task.cancel()
+
+
+async def main(num_workers: int = 1, batch_size: int = settings.WORKER_BATCH_SIZE) -> None:
+    # 1 Redis client (connection pool) dùng chung cho tất cả worker loop
+    rds = create_redis_client()
+    # 1 HTTP client (keep-alive) tới ComfyUI dùng chung cho tất cả job
+    await init_comfy_client()
+    try:
+        tasks = [
+            asyncio.create_task(worker_loop(rds, i, batch_size=batch_size))
+            for i in range(num_workers)
+        ]
+        await asyncio.gather(*tasks)
+    finally:
+        await close_comfy_client()
+        await rds.aclose()
 
 
 if __name__ == "__main__":
-    # Tăng số workers dựa trên khả năng xử lý của ComfyUI
-    # Mỗi worker = 1 job đồng thời
-    asyncio.run(main(num_workers=4))  # 4 jobs cùng lúc
+    # Số job xử lý đồng thời tối đa = num_workers * batch_size
+    # (chỉnh WORKER_BATCH_SIZE theo khả năng xử lý của ComfyUI)
+    if uvloop is not None:
+        # Event loop viết bằng Cython, nhanh hơn loop mặc định của asyncio
+        uvloop.run(main(num_workers=1))
+    else:
+        asyncio.run(main(num_workers=1))
@@ -1,25 +1,62 @@
 # backend/workflow_builder.py
 
-import json
 import random
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, Any
 
+import orjson
+
 from config.settings import settings
 
 
 # Thư mục chứa các file workflow JSON
 WORKFLOWS_DIR = Path(__file__).resolve().parents[1] / "workflows"
 
+# class_type -> tên input mà builder sẽ ghi đè
+_PATCHED_INPUTS = {
+    "KSampler": "seed",
+    "CLIPTextEncode": "text",
+    "TextEncodeQwenImageEdit": "prompt",
+    "LoadImage": "image",
+    "ImageLoader": "image",
+}
+
+
+@lru_cache(maxsize=None)
+def _read_workflow_bytes(filename: str) -> bytes:
+    """
+    Đọc nội dung file workflow 1 lần duy nhất (cache theo filename).
+    """
+    path = WORKFLOWS_DIR / filename
+    return path.read_bytes()
+
 
 def load_workflow(filename: str) -> Dict[str, Any]:
     """
-    Đọc file JSON workflow và trả về dict để ta chỉnh sửa.
+    Trả về 1 bản copy mới (dict) của workflow JSON để ta chỉnh sửa.
+    File chỉ đọc từ đĩa ở lần đầu, các lần sau parse lại từ chuỗi đã cache.
     VD: workflow_gen.json, workflow_edit.json
     """
-    path = WORKFLOWS_DIR / filename
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
+    return orjson.loads(_read_workflow_bytes(filename))
+
+
+@lru_cache(maxsize=None)
+def _node_index(filename: str) -> Dict[str, str]:
+    """
+    Index {class_type: node_id} của workflow template, tính 1 lần khi load.
+    Với mỗi class_type chỉ giữ node đầu tiên có input cần chỉnh
+    (xem _PATCHED_INPUTS), giống thứ tự duyệt dict trước đây.
+    """
+    index: Dict[str, str] = {}
+    for node_id, node in load_workflow(filename).items():
+        if not isinstance(node, dict):
+            continue
+        class_type = node.get("class_type")
+        input_name = _PATCHED_INPUTS.get(class_type)
+        if input_name and class_type not in index and input_name in node.get("inputs", {}):
+            index[class_type] = node_id
+    return index
 
 
 def save_debug_workflow(workflow: Dict[str, Any], filename: str) -> None:
@@ -29,60 +66,41 @@ def save_debug_workflow(workflow: Dict[str, Any], filename: str) -> None:
     debug_dir = WORKFLOWS_DIR / "_debug"
     debug_dir.mkdir(exist_ok=True)
     path = debug_dir / filename
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(workflow, f, indent=2, ensure_ascii=False)
+    path.write_bytes(orjson.dumps(workflow, option=orjson.OPT_INDENT_2))
 
 
-def _set_seed_random(workflow: Dict[str, Any]) -> None:
+def _set_seed_random(workflow: Dict[str, Any], index: Dict[str, str]) -> None:
     """
-    Tìm node KSampler trong workflow và set seed random (64-bit).
+    Set seed random (64-bit) cho node KSampler trong workflow.
     (Giả sử chỉ có 1 KSampler chính – đúng với workflow của bạn.)
     """
-    seed_val = random.randint(0, 2**63 - 1)
-
-    for node_id, node in workflow.items():
-        if not isinstance(node, dict):
-            continue
-        if node.get("class_type") == "KSampler":
-            inputs = node.get("inputs", {})
-            if "seed" in inputs:
-                inputs["seed"] = seed_val
-                # chỉ chỉnh node KSampler đầu tiên là đủ
-                return
+    node_id = index.get("KSampler")
+    if node_id is not None:
+        workflow[node_id]["inputs"]["seed"] = random.getrandbits(63)
 
 
-def _set_prompt_for_gen(workflow: Dict[str, Any], prompt: str) -> None:
+def _set_prompt_for_gen(workflow: Dict[str, Any], index: Dict[str, str], prompt: str) -> None:
     """
     Với workflow GEN ảnh:
-    - Tìm node CLIPTextEncode positive (node có class_type = "CLIPTextEncode"
-      và có key "text" trong inputs)
+    - Node CLIPTextEncode positive (node CLIPTextEncode đầu tiên có key "text"
+      trong inputs)
     - Set text = prompt mới
     """
-    for node_id, node in workflow.items():
-        if not isinstance(node, dict):
-            continue
-        if node.get("class_type") == "CLIPTextEncode":
-            inputs = node.get("inputs", {})
-            if "text" in inputs:
-                inputs["text"] = prompt
-                return
+    node_id = index.get("CLIPTextEncode")
+    if node_id is not None:
+        workflow[node_id]["inputs"]["text"] = prompt
 
 
-def _set_prompt_for_edit(workflow: Dict[str, Any], prompt: str) -> None:
+def _set_prompt_for_edit(workflow: Dict[str, Any], index: Dict[str, str], prompt: str) -> None:
     """
     Với workflow EDIT ảnh:
-    - Tìm node TextEncodeQwenImageEdit positive
+    - Node TextEncodeQwenImageEdit positive
     - Set prompt = prompt mới
     (Giả định node này là node đầu tiên có "prompt" trong inputs)
     """
-    for node_id, node in workflow.items():
-        if not isinstance(node, dict):
-            continue
-        if node.get("class_type") == "TextEncodeQwenImageEdit":
-            inputs = node.get("inputs", {})
-            if "prompt" in inputs:
-                inputs["prompt"] = prompt
-                return
+    node_id = index.get("TextEncodeQwenImageEdit")
+    if node_id is not None:
+        workflow[node_id]["inputs"]["prompt"] = prompt
 
 
 def build_gen_workflow(prompt: str, job_id: str) -> Dict[str, Any]:
@@ -94,12 +112,13 @@ def build_gen_workflow(prompt: str, job_id: str) -> Dict[str, Any]:
     - Gắn _client_id vào trong workflow để ComfyUI tracking
     """
     wf = load_workflow("gen_image.json")
+    index = _node_index("gen_image.json")
 
     # set prompt
-    _set_prompt_for_gen(wf, prompt)
+    _set_prompt_for_gen(wf, index, prompt)
 
     # random seed
-    _set_seed_random(wf)
+    _set_seed_random(wf, index)
 
     # gắn _client_id vào trong prompt (đây là convention của ComfyUI)
     # wf["_client_id"] = job_id
@@ -122,22 +141,18 @@ def build_edit_workflow(prompt: str, base_image_filename: str, job_id: str) -> D
         job_id: Job ID
     """
     wf = load_workflow("edit_image.json")
+    index = _node_index("edit_image.json")
 
-    _set_prompt_for_edit(wf, prompt)
+    _set_prompt_for_edit(wf, index, prompt)
     
     # Set filename trực tiếp (không phải URL)
     print(f"[WorkflowBuilder] Setting LoadImage to filename: {base_image_filename}")
-    for node_id, node in wf.items():
-        if not isinstance(node, dict):
-            continue
-        if node.get("class_type") in ("LoadImage", "ImageLoader"):
-            inputs = node.get("inputs", {})
-            if "image" in inputs:
-                inputs["image"] = base_image_filename
-                print(f"[WorkflowBuilder] Set LoadImage node {node_id} to: {base_image_filename}")
-                break
+    node_id = index.get("LoadImage") or index.get("ImageLoader")
+    if node_id is not None:
+        wf[node_id]["inputs"]["image"] = base_image_filename
+        print(f"[WorkflowBuilder] Set LoadImage node {node_id} to: {base_image_filename}")
     
-    _set_seed_random(wf)
+    _set_seed_random(wf, index)
 
     # save_debug_workflow(wf, f"edit_{job_id[:8]}.json")  # bật nếu muốn debug
     return wf
@@ -12,13 +12,26 @@ class Settings:
     COMFYUI_INPUT_DIR: str = "E:\comfyUI\ComfyUI\input"
 
     REDIS_URL: str = "redis://127.0.0.1:6379/0"
+    REDIS_MAX_CONNECTIONS: int = 64
 
     OLLAMA_HOST: str = "https://ollama.com"
     OLLAMA_MODEL: str = "gpt-oss:120b"
+    # gpt-oss là model suy luận: token "thinking" cũng tính vào num_predict,
+    # nên giữ mức think thấp và chừa đủ token cho cả phần JSON trả về.
+    # Model không hỗ trợ thinking thì đặt OLLAMA_THINK="" (không gửi tham số think)
+    OLLAMA_THINK: str | None = os.getenv("OLLAMA_THINK", "low") or None
+    OLLAMA_NUM_PREDICT: int = int(os.getenv("OLLAMA_NUM_PREDICT", "512"))
 
     OLLAMA_API_KEY: str | None = os.getenv("OLLAMA_API_KEY")
     OPENAI_API_KEY: str | None = os.getenv("OPENAI_API_KEY")
 
     POLL_INTERVAL: float = 0.5  # giây
+    RESULT_WAIT_TIMEOUT: float = 120.0  # giây, thời gian tối đa /ws/result giữ kết nối
+
+    DEBUG_SAVE_WORKFLOWS: bool = os.getenv("DEBUG_SAVE_WORKFLOWS", "0") == "1"  # lưu workflow vào workflows/_debug
+
+    WORKER_BATCH_SIZE: int = 4  # số job tối đa mỗi worker xử lý đồng thời
+
+    IDEMPOTENCY_TTL: int = 120  # giây, tối đa 1 request_id còn trỏ tới job cũ (worker xóa sớm khi job xong)
 
 settings = Settings()
\ No newline at end of file
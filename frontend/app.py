@@ -1,33 +1,146 @@
+import io
 import os
+import re
 import time
+import sqlite3
+import hashlib
+import threading
+import asyncio
+import random
 import datetime
-from typing import Optional
-from io import BytesIO
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
 
-import requests
+import httpx
 import streamlit as st
-from PIL import Image
 
 BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")
+HISTORY_DB = os.getenv("HISTORY_DB", "history.db")
+HISTORY_WINDOW = 20  # Số tin nhắn giữ trong session_state, cũ hơn thì đọc từ sqlite khi cần
 
+BATCH_POLL_SEC = 5.0  # mỗi lượt đợi job batch (fragment tự chạy lại sau mỗi lượt)
+BATCH_TIMEOUT_SEC = 600.0  # quá thời gian này mà job batch chưa xong thì bỏ, báo timeout
 
-def call_generate(user_id: str, prompt: str, mode: Optional[str]) -> Optional[str]:
-    """Gọi POST /generate -> trả về job_id"""
+MAX_PROMPT_LEN = 2000
+_DISALLOWED_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")  # ký tự điều khiển
+
+# Nhãn chế độ ở sidebar -> mode gửi backend (None: backend tự nhận diện)
+MODE_DISPATCH: Dict[str, Optional[str]] = {
+    "🤖 Auto (AI tự nhận diện)": None,
+    "✨ Tạo ảnh mới": "NEW",
+    "✏️ Chỉnh sửa ảnh gần nhất": "EDIT",
+}
+
+
+@st.cache_resource
+def _http() -> httpx.Client:
+    """1 HTTP client (keep-alive, HTTP/2) dùng chung cho mọi lần rerun của Streamlit"""
+    return httpx.Client(
+        base_url=BACKEND_URL,
+        http2=True,
+        timeout=httpx.Timeout(10.0, read=30.0),
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+    )
+
+
+def validate_prompt(prompt: str) -> Optional[str]:
+    """Kiểm tra prompt trước khi gửi, trả về thông báo lỗi (None nếu hợp lệ)"""
+    if not prompt:
+        return "Prompt không được để trống"
+    if len(prompt) > MAX_PROMPT_LEN:
+        return f"Prompt quá dài ({len(prompt)}/{MAX_PROMPT_LEN} ký tự)"
+    if _DISALLOWED_RE.search(prompt):
+        return "Prompt chứa ký tự không hợp lệ"
+    return None
+
+
+def call_generate(
+    user_id: str,
+    prompt: str,
+    mode: Optional[str],
+    request_id: Optional[str] = None,
+) -> Optional[str]:
+    """Gọi POST /generate -> trả về job_id (cùng request_id -> backend trả job cũ)"""
     payload = {"user_id": user_id, "prompt": prompt}
-    if mode and mode != "AUTO":
+    if mode:
         payload["mode"] = mode
+    if request_id:
+        payload["request_id"] = request_id
 
-    resp = requests.post(f"{BACKEND_URL}/generate", json=payload, timeout=30)
+    resp = _http().post("/generate", json=payload)
     resp.raise_for_status()
     data = resp.json()
     return data.get("job_id")
 
 
-def poll_result(job_id: str, timeout_sec: float = 120.0, poll_interval: float = 1.0):
-    """Poll GET /result/{job_id} cho đến khi done/error"""
+@st.cache_resource
+def _async_loop() -> asyncio.AbstractEventLoop:
+    """
+    1 event loop chạy nền (thread riêng) cho mọi lần đợi job. Loop sống qua
+    các lần rerun nên AsyncClient bên dưới giữ được pool kết nối keep-alive.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="job-wait-loop", daemon=True).start()
+    return loop
+
+
+@st.cache_resource
+def _async_http() -> httpx.AsyncClient:
+    """
+    1 AsyncClient (keep-alive, HTTP/2) dùng chung, chỉ dùng trong coroutine
+    chạy trên _async_loop(). Lấy client ở script thread rồi truyền vào coroutine.
+    """
+    return httpx.AsyncClient(
+        base_url=BACKEND_URL,
+        http2=True,
+        timeout=httpx.Timeout(10.0, read=30.0),
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+    )
+
+
+def _run_async(coro) -> "Future":
+    """Chạy coroutine trên loop nền, trả về concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(coro, _async_loop())
+
+
+async def _wait_job(
+    client: httpx.AsyncClient,
+    job_id: str,
+    timeout_sec: float,
+    poll_interval: float = 0.25,
+    max_poll_interval: float = 2.0,
+    long_poll_sec: float = 25.0,
+) -> Optional[dict]:
+    """
+    Đợi job done/error bằng long-poll GET /jobs/{job_id}/wait (server giữ
+    request đến khi job xong, tối đa long_poll_sec mỗi lần).
+    Backend cũ chưa có /jobs/.../wait thì poll GET /result/{job_id}
+    với backoff tăng dần (poll_interval -> max_poll_interval) + jitter.
+    """
     start = time.time()
     while True:
-        resp = requests.get(f"{BACKEND_URL}/result/{job_id}", timeout=10)
+        remaining = timeout_sec - (time.time() - start)
+        if remaining <= 0:
+            return None
+
+        wait_sec = min(long_poll_sec, remaining)
+        resp = await client.get(
+            f"/jobs/{job_id}/wait",
+            params={"timeout": wait_sec},
+            timeout=wait_sec + 10,
+        )
+        if resp.status_code == 404:
+            # Job không tồn tại hoặc backend không hỗ trợ long-poll -> để /result quyết định
+            break
+        resp.raise_for_status()
+
+        data = resp.json()
+        if data.get("status") in ("done", "error"):
+            return data
+
+    interval = poll_interval
+    while True:
+        resp = await client.get(f"/result/{job_id}", timeout=10)
         if resp.status_code == 404:
             return None
 
@@ -37,22 +150,334 @@ def poll_result(job_id: str, timeout_sec: float = 120.0, poll_interval: float =
         if status in ("done", "error"):
             return data
 
-        if time.time() - start > timeout_sec:
+        remaining = timeout_sec - (time.time() - start)
+        if remaining <= 0:
             return None
 
-        time.sleep(poll_interval)
+        await asyncio.sleep(min(interval + random.uniform(0, interval * 0.1), remaining))
+        interval = min(interval * 2, max_poll_interval)
 
 
-def download_image(image_url: str):
-    """Download ảnh từ URL và convert sang PIL Image"""
+async def poll_result_async(
+    client: httpx.AsyncClient,
+    job_id: str,
+    timeout_sec: float = 120.0,
+) -> Optional[dict]:
+    """Đợi 1 job; wait_for chặn cứng timeout_sec kể cả khi request HTTP bị treo"""
     try:
-        resp = requests.get(image_url, timeout=30)
+        return await asyncio.wait_for(_wait_job(client, job_id, timeout_sec), timeout_sec)
+    except asyncio.TimeoutError:
+        return None
+
+
+def poll_result(job_id: str, timeout_sec: float = 120.0) -> Optional[dict]:
+    return _run_async(poll_result_async(_async_http(), job_id, timeout_sec)).result()
+
+
+async def _wait_batch_job(
+    client: httpx.AsyncClient,
+    job_id: str,
+    timeout_sec: float,
+) -> Optional[dict]:
+    """
+    Như _wait_job, nhưng hết timeout thì trả về trạng thái hiện tại
+    (waiting/processing) để job được đợi tiếp ở lượt sau. None: job không tồn tại.
+    """
+    result = await _wait_job(client, job_id, timeout_sec)
+    if result is None:
+        resp = await client.get(f"/result/{job_id}", timeout=10)
+        if resp.status_code != 404:
+            resp.raise_for_status()
+            result = resp.json()
+    return result
+
+
+def submit_waits(job_ids: List[str], timeout_sec: float = 120.0) -> Dict["Future", str]:
+    """
+    Đợi nhiều job song song trên loop nền (chung 1 kết nối HTTP/2).
+    Trả về {future: job_id}, dùng với as_completed để job nào xong trước hiển thị trước.
+    """
+    client = _async_http()
+    return {
+        _run_async(_wait_batch_job(client, job_id, timeout_sec)): job_id
+        for job_id in job_ids
+    }
+
+
+def result_timestamp(result: dict) -> str:
+    """
+    Timestamp đặt tên file ảnh (YYYYmmdd_HHMMSS), lấy từ completed_at do backend
+    trả về để không phải gọi datetime.now() phía client.
+    """
+    completed_at = result.get("completed_at")
+    if completed_at:
+        return completed_at.replace("-", "").replace(":", "").replace("T", "_")[:15]
+    return datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+
+
+@st.cache_data(show_spinner=False, max_entries=128, ttl=3600)
+def _fetch_image_bytes(image_url: str, job_id: str) -> bytes:
+    """
+    Tải ảnh 1 lần cho mỗi job (lỗi thì không cache). Cache theo cả job_id vì
+    ComfyUI dùng lại tên file output sau khi thư mục output bị dọn.
+    """
+    with _http().stream("GET", image_url) as resp:
         resp.raise_for_status()
-        img = Image.open(BytesIO(resp.content)).convert("RGB")
-        return img, resp.content
+        # Ghi từng chunk vào 1 buffer duy nhất; getvalue() trả về chính buffer
+        # đó dạng bytes (không copy thêm) -> st.image / download_button dùng trực tiếp
+        buf = io.BytesIO()
+        for chunk in resp.iter_bytes(64 * 1024):
+            buf.write(chunk)
+        return buf.getvalue()
+
+
+@st.cache_resource
+def _executor() -> ThreadPoolExecutor:
+    """Thread pool tải ảnh nền, dùng chung cho mọi lần rerun"""
+    return ThreadPoolExecutor(max_workers=4)
+
+
+def start_download(image_url: str, job_id: str) -> "Future[bytes]":
+    """Bắt đầu tải ảnh ở thread nền, để UI dựng tiếp trong lúc chờ mạng"""
+    return _executor().submit(_fetch_image_bytes, image_url, job_id)
+
+
+def download_image(download: "Future[bytes]") -> Optional[bytes]:
+    """Đợi ảnh tải xong, trả về bytes PNG gốc (st.image hiển thị trực tiếp)"""
+    try:
+        return download.result()
     except Exception as e:
         st.error(f"Không thể tải ảnh: {e}")
-        return None, None
+        return None
+
+
+@st.cache_resource
+def _history_db() -> sqlite3.Connection:
+    """1 kết nối sqlite dùng chung cho mọi session, lưu lịch sử chat theo user_id"""
+    conn = sqlite3.connect(HISTORY_DB, check_same_thread=False)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            ts TEXT,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            image_url TEXT,
+            image_key TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, id);
+        -- Mỗi ảnh chỉ lưu 1 lần, khóa theo hash nội dung ảnh
+        -- (không theo URL: ComfyUI có thể dùng lại tên file cho ảnh khác)
+        CREATE TABLE IF NOT EXISTS images (
+            key TEXT PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+    """)
+    return conn
+
+
+@st.cache_resource
+def _history_lock() -> threading.Lock:
+    """Các session Streamlit chạy trên nhiều thread -> khóa quanh kết nối sqlite"""
+    return threading.Lock()
+
+
+def _image_key(img_bytes: bytes) -> str:
+    return hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+
+
+def save_message(user_id: str, msg: dict) -> int:
+    """Ghi 1 tin nhắn vào sqlite, trả về id"""
+    image_key = None
+    if msg.get("img_bytes"):
+        image_key = _image_key(msg["img_bytes"])
+
+    with _history_lock(), _history_db() as conn:
+        if image_key:
+            conn.execute(
+                "INSERT OR IGNORE INTO images (key, data) VALUES (?, ?)",
+                (image_key, msg["img_bytes"]),
+            )
+        cur = conn.execute(
+            "INSERT INTO messages (user_id, ts, role, content, image_url, image_key)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, msg.get("timestamp"), msg["role"], msg["content"], msg.get("image_url"), image_key),
+        )
+    return cur.lastrowid
+
+
+def load_messages(
+    user_id: str,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> List[dict]:
+    """
+    Đọc tin nhắn của user theo thứ tự cũ -> mới.
+    before_id: chỉ lấy tin cũ hơn id này; limit: lấy N tin gần nhất.
+    """
+    sql = (
+        "SELECT m.id, m.ts, m.role, m.content, m.image_url, i.data"
+        " FROM messages m LEFT JOIN images i ON i.key = m.image_key"
+        " WHERE m.user_id = ?"
+    )
+    params: list = [user_id]
+    if before_id is not None:
+        sql += " AND m.id < ?"
+        params.append(before_id)
+    sql += " ORDER BY m.id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    with _history_lock():
+        rows = _history_db().execute(sql, params).fetchall()
+
+    messages = []
+    for msg_id, ts, role, content, image_url, img_bytes in reversed(rows):
+        msg = {"id": msg_id, "role": role, "content": content}
+        if image_url:
+            msg["image_url"] = image_url
+        if img_bytes:
+            msg["img_bytes"] = img_bytes
+        if ts:
+            msg["timestamp"] = ts
+        messages.append(msg)
+    return messages
+
+
+def count_messages(user_id: str, before_id: int) -> int:
+    with _history_lock():
+        row = _history_db().execute(
+            "SELECT COUNT(*) FROM messages WHERE user_id = ? AND id < ?",
+            (user_id, before_id),
+        ).fetchone()
+    return row[0]
+
+
+def history_stats(user_id: str) -> Tuple[int, int]:
+    """(số tin nhắn của user, số ảnh đã tạo) trên toàn bộ lịch sử"""
+    with _history_lock():
+        row = _history_db().execute(
+            "SELECT COALESCE(SUM(role = 'user'), 0), COUNT(image_key)"
+            " FROM messages WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+    return row[0], row[1]
+
+
+def clear_history(user_id: str) -> None:
+    with _history_lock(), _history_db() as conn:
+        conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+        conn.execute(
+            "DELETE FROM images WHERE key NOT IN"
+            " (SELECT image_key FROM messages WHERE image_key IS NOT NULL)"
+        )
+
+
+def add_message(msg: dict) -> None:
+    """
+    Thêm tin nhắn vào lịch sử: ghi sqlite, session_state chỉ giữ
+    HISTORY_WINDOW tin gần nhất để mỗi lần rerun không phải serialize cả lịch sử.
+    """
+    msg["id"] = save_message(st.session_state["user_id"], msg)
+    messages = st.session_state["messages"]
+    messages.append(msg)
+    if len(messages) > HISTORY_WINDOW:
+        del messages[:-HISTORY_WINDOW]
+
+
+def render_message(msg: dict) -> None:
+    """
+    Hiển thị 1 tin nhắn trong lịch sử chat.
+    Ảnh lưu sẵn dạng bytes PNG -> st.image dùng trực tiếp, không decode lại.
+    """
+    with st.chat_message(msg["role"]):
+        st.markdown(msg["content"])
+        
+        img_bytes = msg.get("img_bytes")
+        if img_bytes:
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col2:
+                st.image(img_bytes, use_container_width=True)
+        
+        if "image_url" in msg and msg["image_url"]:
+            st.markdown(f"🔗 [Mở ảnh gốc]({msg['image_url']})")
+        
+        if img_bytes:
+            ts = msg.get("timestamp") or datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            st.download_button(
+                "⬇️ Tải ảnh",
+                data=img_bytes,
+                file_name=f"qwen_image_{ts}.png",
+                mime="image/png",
+                key=f"download_{msg['id']}"  # id sqlite: duy nhất kể cả khi trùng image_url
+            )
+
+
+def batch_result_message(job: dict, result: Optional[dict]) -> Optional[dict]:
+    """Tin nhắn kết quả cho 1 job batch; None nếu job chưa xong (đợi tiếp lượt sau)"""
+    if result is None:
+        return {"role": "assistant", "content": f"❌ Job không tồn tại: *{job['prompt']}*"}
+
+    status = result.get("status")
+    if status == "error":
+        content = f"❌ Lỗi: {result.get('error_message', 'Lỗi không xác định')}"
+    elif status == "done" and result.get("image_url"):
+        img_bytes = download_image(start_download(result["image_url"], job["job_id"]))
+        if img_bytes:
+            return {
+                "role": "assistant",
+                "content": f"✨ Đây là ảnh cho: *{job['prompt']}*",
+                "image_url": result["image_url"],
+                "img_bytes": img_bytes,
+                "timestamp": result_timestamp(result),
+            }
+        content = "⚠️ Không thể tải ảnh từ URL"
+    elif status == "done":
+        content = "⚠️ Có lỗi xảy ra, vui lòng thử lại."
+    else:
+        return None
+    return {"role": "assistant", "content": content}
+
+
+@st.fragment(run_every=BATCH_POLL_SEC)
+def batch_waiter() -> None:
+    """
+    Đợi các job batch trong 1 fragment tự chạy lại mỗi BATCH_POLL_SEC giây:
+    chỉ fragment chạy lại, ô chat và các widget khác vẫn dùng được trong lúc chờ.
+    """
+    inflight = st.session_state["inflight"]
+    if not inflight:
+        return
+
+    jobs = {job["job_id"]: job for job in inflight}
+    waits = submit_waits(list(jobs), timeout_sec=BATCH_POLL_SEC)
+    finished = False
+    with st.spinner(f"🎨 AI đang xử lý {len(inflight)} yêu cầu..."):
+        # Job nào xong trước hiển thị ngay, không đợi job chậm nhất
+        for fut in as_completed(waits):
+            job = jobs[waits[fut]]
+            try:
+                msg = batch_result_message(job, fut.result())
+            except Exception as e:
+                msg = {"role": "assistant", "content": f"❌ Lỗi: {str(e)}"}
+            if msg is None:
+                if time.time() - job["submitted_at"] < BATCH_TIMEOUT_SEC:
+                    continue
+                # Job kẹt ở waiting/processing (vd. worker chết giữa chừng) -> bỏ
+                msg = {"role": "assistant", "content": f"❌ Timeout - vui lòng thử lại: *{job['prompt']}*"}
+
+            st.session_state["inflight"] = [
+                j for j in st.session_state["inflight"] if j["job_id"] != job["job_id"]
+            ]
+            add_message(msg)
+            render_message(msg)
+            finished = True
+
+    if finished:
+        # Chạy lại cả trang để kết quả vào phần lịch sử
+        # (lần chạy lại sau của fragment sẽ xóa những gì nó đã hiển thị)
+        st.rerun()
 
 
 # ==========================
@@ -77,8 +502,13 @@ if "messages" not in st.session_state:
         "content": "Xin chào! Tôi có thể giúp bạn tạo hoặc chỉnh sửa ảnh. Hãy mô tả ảnh bạn muốn! 💬",
     })
 
+if "inflight" not in st.session_state:
+    # Các job batch đã gửi, đang đợi kết quả: [{"job_id", "prompt", "submitted_at"}]
+    st.session_state["inflight"] = []
+
 if "user_id" not in st.session_state:
-    st.session_state["user_id"] = f"user_{int(time.time())}"
+    # Lấy lại user_id từ URL (?uid=...) để mở lại trang vẫn thấy lịch sử cũ
+    st.session_state["user_id"] = st.query_params.get("uid") or f"user_{int(time.time())}"
 
 # ==========================
 # Sidebar
@@ -93,27 +523,63 @@ with st.sidebar:
         help="Mỗi user có lịch sử ảnh riêng"
     )
     st.session_state["user_id"] = user_id
+    if st.query_params.get("uid") != user_id:
+        st.query_params["uid"] = user_id
+    
+    if st.session_state.get("history_user") != user_id:
+        # Session mới hoặc đổi user: nạp các tin nhắn gần nhất từ sqlite
+        history = load_messages(user_id, limit=HISTORY_WINDOW)
+        if history or "history_user" in st.session_state:
+            st.session_state["messages"] = history
+        st.session_state["history_user"] = user_id
     
     st.markdown("---")
     
     # Mode selection
     mode_option = st.radio(
         "🎯 Chế độ",
-        ["🤖 Auto (AI tự nhận diện)", "✨ Tạo ảnh mới", "✏️ Chỉnh sửa ảnh gần nhất"],
+        list(MODE_DISPATCH),
         help="Auto: AI phân tích prompt\nTạo mới: Luôn gen ảnh mới\nEdit: Chỉnh sửa ảnh trước đó"
     )
+    mode = MODE_DISPATCH[mode_option]
     
-    if mode_option == "🤖 Auto (AI tự nhận diện)":
-        mode = None
-    elif mode_option == "✨ Tạo ảnh mới":
-        mode = "NEW"
-    else:
-        mode = "EDIT"
+    st.markdown("---")
+    
+    # Batch: gửi nhiều prompt 1 lần, các job chạy song song
+    with st.expander("📦 Chạy hàng loạt"):
+        batch_text = st.text_area(
+            "Mỗi dòng 1 prompt",
+            key="batch_prompts",
+            help="Các prompt được gửi cùng lúc, job nào xong trước hiển thị trước",
+        )
+        if st.button("🚀 Chạy batch", use_container_width=True):
+            for prompt in (line.strip() for line in batch_text.splitlines()):
+                if not prompt:
+                    continue
+                error = validate_prompt(prompt)
+                if error:
+                    st.error(f"❌ {prompt[:30]}: {error}")
+                    continue
+                add_message({"role": "user", "content": prompt})
+                try:
+                    job_id = call_generate(user_id=user_id, prompt=prompt, mode=mode)
+                    st.session_state["inflight"].append({
+                        "job_id": job_id,
+                        "prompt": prompt,
+                        "submitted_at": time.time(),
+                    })
+                except Exception as e:
+                    add_message({
+                        "role": "assistant",
+                        "content": f"❌ Lỗi: {str(e)}"
+                    })
     
     st.markdown("---")
     
     # Clear chat
     if st.button("🗑️ Xóa lịch sử chat", use_container_width=True):
+        clear_history(user_id)
+        st.session_state["inflight"] = []
         st.session_state["messages"] = []
         st.session_state["messages"].append({
             "role": "assistant",
@@ -122,8 +588,7 @@ with st.sidebar:
         st.rerun()
     
     # Statistics
-    num_messages = len([m for m in st.session_state["messages"] if m["role"] == "user"])
-    num_images = len([m for m in st.session_state["messages"] if "image" in m])
+    num_messages, num_images = history_stats(user_id)
     st.markdown(f"**💬 Tin nhắn:** {num_messages}")
     st.markdown(f"**🖼️ Ảnh đã tạo:** {num_images}")
     
@@ -139,85 +604,87 @@ with st.sidebar:
 # ==========================
 # Hiển thị lịch sử chat
 # ==========================
+first_id = next((m["id"] for m in st.session_state["messages"] if "id" in m), None)
+num_older = count_messages(user_id, before_id=first_id) if first_id else 0
+if num_older:
+    with st.expander(f"🕘 Tin nhắn cũ hơn ({num_older})"):
+        # Chỉ đọc sqlite khi người dùng thật sự muốn xem
+        if st.toggle("Hiển thị", key="show_older"):
+            for msg in load_messages(user_id, before_id=first_id):
+                render_message(msg)
+
 for msg in st.session_state["messages"]:
-    with st.chat_message(msg["role"]):
-        st.markdown(msg["content"])
-        
-        if "image" in msg:
-            col1, col2, col3 = st.columns([1, 2, 1])
-            with col2:
-                st.image(msg["image"], use_container_width=True)
-        
-        if "image_url" in msg and msg["image_url"]:
-            st.markdown(f"🔗 [Mở ảnh gốc]({msg['image_url']})")
-        
-        if "download_data" in msg and msg["download_data"]:
-            ts = msg.get("timestamp", datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
-            st.download_button(
-                "⬇️ Tải ảnh",
-                data=msg["download_data"],
-                file_name=f"qwen_image_{ts}.png",
-                mime="image/png",
-                key=f"download_{ts}"
-            )
+    render_message(msg)
 
 # ==========================
 # Ô nhập prompt
 # ==========================
 user_prompt = st.chat_input("💭 Nhập mô tả ảnh hoặc yêu cầu chỉnh sửa...")
 
+# Prompt lỗi thì báo ngay, không tốn 1 lượt gửi + đợi backend
+if user_prompt is not None:
+    user_prompt = user_prompt.strip()
+    prompt_error = validate_prompt(user_prompt)
+    if prompt_error:
+        st.error(f"❌ {prompt_error}")
+        user_prompt = None  # không gửi, nhưng vẫn chạy tới phần đợi job batch bên dưới
+
 if user_prompt:
+    # Idempotency key: gửi lại cùng (user, prompt, mode) khi job trước chưa xong
+    # (vd. run trước bị ngắt) -> backend trả về job đang chạy, client đợi tiếp job đó
+    req_id = hashlib.blake2b(f"{user_id}|{user_prompt}|{mode}".encode(), digest_size=8).hexdigest()
+    
     # Add user message
-    st.session_state["messages"].append({
+    add_message({
         "role": "user",
         "content": user_prompt
     })
+    with st.chat_message("user"):
+        st.markdown(user_prompt)
     
-    # Show assistant thinking
+    # Show assistant thinking: 1 khung st.status, cập nhật label/state theo từng bước
     with st.chat_message("assistant"):
-        st.markdown("⏳ Đang xử lý...")
-        
-        status_container = st.empty()
-        status_container.info(f"🎯 Chế độ: **{mode_option}**")
+        status = st.status(f"⏳ Đang xử lý... 🎯 Chế độ: {mode_option}")
         
         try:
             # Call backend
-            job_id = call_generate(user_id=user_id, prompt=user_prompt, mode=mode)
-            status_container.success(f"✅ Job ID: `{job_id}`")
+            job_id = call_generate(user_id=user_id, prompt=user_prompt, mode=mode, request_id=req_id)
+            status.update(label=f"🎨 AI đang tạo ảnh của bạn... (Job ID: {job_id})")
             
             # Poll result
-            with st.spinner("🎨 AI đang tạo ảnh của bạn..."):
-                result = poll_result(job_id, timeout_sec=120.0, poll_interval=1.0)
+            result = poll_result(job_id, timeout_sec=120.0)
             
             if not result:
-                st.error("⏱️ Hết thời gian chờ. Vui lòng thử lại!")
-                st.session_state["messages"].append({
+                status.update(label="⏱️ Hết thời gian chờ. Vui lòng thử lại!", state="error")
+                add_message({
                     "role": "assistant",
                     "content": "❌ Timeout - vui lòng thử lại."
                 })
             
             elif result.get("status") == "error":
                 error_msg = result.get("error_message", "Lỗi không xác định")
-                st.error(f"❌ Lỗi: {error_msg}")
-                st.session_state["messages"].append({
+                status.update(label=f"❌ Lỗi: {error_msg}", state="error")
+                add_message({
                     "role": "assistant",
                     "content": f"❌ Lỗi: {error_msg}"
                 })
             
             elif result.get("status") == "done" and result.get("image_url"):
                 image_url = result["image_url"]
-                st.success("✅ Hoàn thành!")
+                # Tải ảnh song song với việc dựng khung hiển thị
+                download = start_download(image_url, job_id)
+                status.update(label="✅ Hoàn thành!", state="complete")
+                col1, col2, col3 = st.columns([1, 2, 1])
                 
-                # Download và hiển thị ảnh
-                image, img_bytes = download_image(image_url)
+                # Đợi ảnh và hiển thị
+                img_bytes = download_image(download)
                 
-                if image:
-                    col1, col2, col3 = st.columns([1, 2, 1])
+                if img_bytes:
                     with col2:
-                        st.image(image, caption="✨ Kết quả", use_container_width=True)
+                        st.image(img_bytes, caption="✨ Kết quả", use_container_width=True)
                     
                     # Download button
-                    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                    ts = result_timestamp(result)
                     st.download_button(
                         "⬇️ Tải ảnh",
                         data=img_bytes,
@@ -228,29 +695,34 @@ if user_prompt:
                     st.markdown(f"🔗 [Mở ảnh gốc]({image_url})")
                     
                     # Save to history
-                    st.session_state["messages"].append({
+                    add_message({
                         "role": "assistant",
                         "content": "✨ Đây là ảnh của bạn!",
-                        "image": image,
                         "image_url": image_url,
-                        "download_data": img_bytes,
+                        "img_bytes": img_bytes,
                         "timestamp": ts
                     })
                 else:
-                    st.warning("⚠️ Không thể tải ảnh từ URL")
+                    status.update(label="⚠️ Không thể tải ảnh từ URL", state="error")
             
             else:
-                st.warning("⚠️ Phản hồi không hợp lệ từ server")
-                st.session_state["messages"].append({
+                status.update(label="⚠️ Phản hồi không hợp lệ từ server", state="error")
+                add_message({
                     "role": "assistant",
                     "content": "⚠️ Có lỗi xảy ra, vui lòng thử lại."
                 })
         
         except Exception as e:
-            st.error(f"❌ Lỗi: {e}")
-            st.session_state["messages"].append({
+            status.update(label=f"❌ Lỗi: {e}", state="error")
+            add_message({
                 "role": "assistant",
                 "content": f"❌ Lỗi: {str(e)}"
             })
-    
-    st.rerun()
+    # Không st.rerun(): tin nhắn vừa rồi đã hiển thị ngay trong lần chạy này,
+    # lần tương tác sau sẽ render lại từ lịch sử
+
+# ==========================
+# Đợi các job batch (sau ô chat, để ô chat luôn hiển thị và dùng được)
+# ==========================
+if st.session_state["inflight"]:
+    batch_waiter()